@@ -10,10 +10,18 @@ import random
 import socket
 import os
 import requests
-import shutil
 import json
+import time
 
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+# number of images probed concurrently on each wave of a remote scan
+SCAN_WAVE_SIZE = 8
+
+# size of the chunks streamed from the network to the staging files
+DOWNLOAD_CHUNK_SIZE = 65536
 
 
 def connected(host="8.8.8.8", port=53, timeout=3):
@@ -22,11 +30,12 @@ def connected(host="8.8.8.8", port=53, timeout=3):
     Host: 8.8.8.8 (google-public-dns-a.google.com)
     OpenPort: 53/tcp
     Service: domain (DNS/TCP)
+    The timeout applies to this probe's socket only, rather than mutating
+    the process-wide default, and the socket is closed when done
     """
     try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        return True
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
     except socket.error as ex:
         return False
 
@@ -46,11 +55,14 @@ class ImageSet:
 	def __init__(
 			self,
 			name, baseDir, urlRoot, auto,
-			imageTypes=["png"], randomise=False, gap=5, refreshMins= 30, remotePrefix = ''
+			imageTypes=["png"], randomise=False, gap=5, refreshMins= 30, remotePrefix = '',
+			cacheLimitMB=None
 		):
 		'''
 		Files are expected to be on the web at <urlRoot><remotePrefix><name>.000.<imageTypes[0]>
 		Only one file type is supported for remote files (the first specified in imageTypes)
+		cacheLimitMB bounds the total size of the cache directory, with the least
+		recently downloaded files evicted first. The default of None means unbounded.
 		'''
 		self.name = name
 		self.baseDir = baseDir
@@ -60,14 +72,45 @@ class ImageSet:
 		self.gap = gap
 		self.randomise = randomise
 		self.imageNames = []
+		self._sortedNames = []
+		self._localCount = 0
 		self.currentIndex = 0
 		self.lastUpdate = None
 		self.remotePrefix = remotePrefix
 		self.firstRemoteIndex = 0
 		self.refreshMins = refreshMins
+		self.cacheLimitMB = cacheLimitMB
+		self._dirCache = {}
+		# the directory paths never change, so build the strings once here
+		# instead of re-concatenating them on every property access
+		self._rootDir = f"{baseDir}{name}"
+		self._stagingDir = f"{baseDir}{name}/staging/"
+		self._cacheDir = f"{baseDir}{name}/cache/"
+		self._localDir = f"{baseDir}{name}/local/"
+		self._cacheIndexName = f"{baseDir}{name}/cacheIndex.json"
+		# one session for all web requests so the HTTPS connection is kept alive
+		# between files rather than paying a fresh TCP/TLS handshake per image
+		self._session = requests.Session()
+		self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+		self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+		self._session.headers['Connection'] = 'keep-alive'
 		self.setUpDirs()
 
 
+	def close(self):
+		'''
+		Close the web session and its pooled connections
+		'''
+		self._session.close()
+
+
+	def __del__(self):
+		try:
+			self.close()
+		except Exception:
+			pass
+
+
 	@property
 	def simpleMode(self):
 		return self.urlRoot is None
@@ -78,23 +121,23 @@ class ImageSet:
 
 	@property
 	def rootDir(self):
-		return self.baseDir + self.name
+		return self._rootDir
 
 	@property
 	def stagingDir(self):
-		return self.baseDir + self.name + "/staging/"
+		return self._stagingDir
 
 	@property
 	def cacheDir(self):
-		return self.baseDir + self.name + "/cache/"
+		return self._cacheDir
 
 	@property
 	def localDir(self):
-		return self.baseDir + self.name + "/local/"
+		return self._localDir
 
 	@property
 	def cacheIndexName(self):
-		return self.baseDir + self.name + "/cacheIndex.json"
+		return self._cacheIndexName
 
 
 	def setUpDirs(self):
@@ -112,26 +155,42 @@ class ImageSet:
 		checkDir(self.stagingDir)
 
 
+	def invalidateDirCache(self):
+		'''
+		Discard cached directory listings, forcing the next getFilesIn to rescan
+		'''
+		self._dirCache = {}
+
+
 	def getFilesIn(self, path, suffixes, fullpath=True):
 		'''
 		Returns a list of file paths or names in the directory which match the suffixes
 		Returns either the full path (default), or just the file name (fullPath=False)
+		Listings are cached until invalidateDirCache is called, so repeated calls
+		between refreshes do not rescan the directory
 		'''
 
 		if self.simpleMode and path != self.localDir:
 			# ignore contents of all but the local dir in simple mode
 			return []
 
+		cacheKey = (path, tuple(suffixes), fullpath)
+		if cacheKey in self._dirCache:
+			return list(self._dirCache[cacheKey])
+
 		files = []
+		# lower the suffixes into a set once, rather than per entry in the loop
+		wanted = {suffix.lower() for suffix in suffixes}
 		# NB "os.scandir ... The entries are yielded in arbitrary order"
 		with os.scandir(path) as entries:
 			for entry in entries:
 				if entry.is_file():
-					suffix = entry.name.split('.')[-1:][0].lower()
-					if suffix in suffixes:
+					# rpartition avoids building a list of all the name parts
+					if entry.name.rpartition('.')[2].lower() in wanted:
 						files.append(entry.path if fullpath else entry.name)
 		files.sort()
-		return files
+		self._dirCache[cacheKey] = files
+		return list(files)
 
 
 	def clearStaging(self):
@@ -141,6 +200,7 @@ class ImageSet:
 		staged = self.getFilesIn(self.stagingDir, self.imageTypes)
 		for path in staged:
 			os.remove(path)
+		self.invalidateDirCache()
 
 
 	def updateImages(self):
@@ -150,6 +210,9 @@ class ImageSet:
 		Updates are identified using the cache index. If no cache index is found all images are treated as new
 		'''
 
+		# rescan the directories so manually managed content is picked up
+		self.invalidateDirCache()
+
 		if self.simpleMode:
 			self.refreshImageNames()
 			return
@@ -165,109 +228,178 @@ class ImageSet:
 		CACHE_STATUS_DELETED = 4
 
 		KEY_LAST_MOD = 'Last-Modified'
+		KEY_IF_MOD = 'If-Modified-Since'
+		KEY_RANGE = 'Range'
+		KEY_IF_RANGE = 'If-Range'
 		KEY_STATUS = 'Status'
 
 		self.clearStaging()
 		# load cache index
 		try:
-			oldIndexFile = open(self.cacheIndexName, 'r')
-			oldIndex = json.loads(oldIndexFile.read())
+			with open(self.cacheIndexName, 'r') as oldIndexFile:
+				oldIndex = json.load(oldIndexFile)
 		except Exception as e:
 			oldIndex = {}
 		newIndex = {}
 		cachedNames = self.getFilesIn(self.cacheDir, self.imageTypes, fullpath=False)
-		# scan remote repository
-		imageNo = 1
-		gap = 0
-		trying = True
-		while gap <= self.gap:
+
+		def fetchImage(imageNo):
+			'''
+			Issue the conditional GET for one image number, returning the
+			filename, staging path, response (or None) and status code
+			'''
 			filename = f"{self.remotePrefix}{self.name}.{imageNo:03}.{self.imageTypes[0]}"
 			url = f"{self.urlRoot}{filename}"
 			print(f"... Looking for {url}")
 			stageName = f"{self.stagingDir}{filename}"
-			headers = None
+			# downloads go to a .part file which survives clearStaging, so an
+			# interrupted transfer can be resumed with a Range request
+			partName = f"{stageName}.part"
+			have = os.path.getsize(partName) if os.path.exists(partName) else 0
+			# a single conditional GET replaces the old HEAD + GET pair, halving round trips per file
+			headers = {}
+			if have > 0:
+				# ask for the missing tail only; If-Range falls back to the
+				# full file if it changed on the server since the partial
+				headers[KEY_RANGE] = f"bytes={have}-"
+				if filename in oldIndex and oldIndex[filename][KEY_LAST_MOD] is not None:
+					headers[KEY_IF_RANGE] = oldIndex[filename][KEY_LAST_MOD]
+			elif filename in oldIndex and oldIndex[filename][KEY_LAST_MOD] is not None:
+				headers[KEY_IF_MOD] = oldIndex[filename][KEY_LAST_MOD]
 			try:
-				headerReq = requests.head(url)
-				found = headerReq.status_code == 200
-				if found:
-					headers = headerReq.headers
-				else:
-					print(f"...... Not found, status {headerReq.status_code}")
+				# stream=True defers the body so it can be copied to disk in
+				# chunks rather than buffered whole in memory
+				r = self._session.get(url, headers=headers, allow_redirects=True, stream=True)
+				statusCode = r.status_code
 			except Exception as e:
 				print(f"...... request failed - {e}")
-				found = False
-			status = CACHE_STATUS_NONE
-			if found:
-				if filename in oldIndex:
-					# in the index, check update DTS
-					if 'Last-Modified' in headers:
-						if headers[KEY_LAST_MOD] == oldIndex[filename][KEY_LAST_MOD]:
+				r = None
+				statusCode = None
+			return filename, stageName, partName, r, statusCode
+
+		# scan the remote repository in concurrent waves so that network latency
+		# overlaps across files instead of being paid one image at a time
+		imageNo = 1
+		gap = 0
+		with ThreadPoolExecutor(max_workers=SCAN_WAVE_SIZE) as executor:
+			while gap <= self.gap:
+				wave = executor.map(fetchImage, range(imageNo, imageNo + SCAN_WAVE_SIZE))
+				for filename, stageName, partName, r, statusCode in wave:
+					if gap > self.gap:
+						# already past the end of the set, ignore the rest of the
+						# wave, but still release each response back to the pool
+						if r is not None:
+							r.close()
+						continue
+					if statusCode == 304:
+						# not modified since the cached copy, no body transferred
+						newIndex[filename] = {KEY_STATUS : CACHE_STATUS_UPTODATE, KEY_LAST_MOD : oldIndex[filename][KEY_LAST_MOD]}
+					elif statusCode in (200, 206, 416):
+						lastMod = r.headers[KEY_LAST_MOD] if KEY_LAST_MOD in r.headers else None
+						if statusCode != 200 and lastMod is None and filename in oldIndex:
+							# tail and range-satisfied responses may omit the DTS, keep the stored one
+							lastMod = oldIndex[filename][KEY_LAST_MOD]
+						if statusCode == 200 and filename in oldIndex and lastMod is not None and lastMod == oldIndex[filename][KEY_LAST_MOD]:
+							# some servers ignore the conditional, so check the update DTS as well
 							status = CACHE_STATUS_UPTODATE
-						else:
+						elif filename in oldIndex and lastMod is not None:
 							status = CACHE_STATUS_UPDATED
+						else:
+							status = CACHE_STATUS_NEW
+						newIndex[filename] = {KEY_STATUS : status, KEY_LAST_MOD : lastMod}
+						if status != CACHE_STATUS_UPTODATE:
+							try:
+								if statusCode != 416:
+									# on 416 the partial already holds the complete file
+									mode = 'ab' if statusCode == 206 else 'wb'
+									with open(partName, mode) as stage:
+										for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+											stage.write(chunk)
+								os.replace(partName, stageName)
+							except Exception as e:
+								# the partial is kept so the next refresh can resume it
+								print(f"...... download failed - {e}")
+								del newIndex[filename]
+								if filename in oldIndex:
+									# keep the cached copy (and its validator) until a
+									# replacement actually lands
+									newIndex[filename] = {KEY_STATUS : CACHE_STATUS_UPTODATE, KEY_LAST_MOD : oldIndex[filename][KEY_LAST_MOD]}
+								gap += 1
 					else:
-						status = CACHE_STATUS_NEW
-				else:
-					status = CACHE_STATUS_NEW
-				newIndex[filename] = {KEY_STATUS : status, KEY_LAST_MOD : headers[KEY_LAST_MOD] if KEY_LAST_MOD in headers else None}
-			else:
-				gap += 1
-				if filename in oldIndex or filename in cachedNames:
-					status = CACHE_STATUS_DELETED
-					newIndex[filename] = {KEY_STATUS : status, KEY_LAST_MOD : None}
-			r = None
-			if status == CACHE_STATUS_UPDATED or status == CACHE_STATUS_NEW:
+						if statusCode is not None:
+							print(f"...... Not found, status {statusCode}")
+						gap += 1
+						if filename in oldIndex or filename in cachedNames:
+							newIndex[filename] = {KEY_STATUS : CACHE_STATUS_DELETED, KEY_LAST_MOD : None}
+					if r is not None:
+						# release the connection back to the pool
+						r.close()
+				imageNo += SCAN_WAVE_SIZE
+		# promote staged files, apply deletions and build the index to save in
+		# a single pass over the scan results
+		finalIndex = {}
+		for filename, entry in newIndex.items():
+			if entry[KEY_STATUS] in (CACHE_STATUS_NEW, CACHE_STATUS_UPDATED):
+				# staging and cache share a filesystem, so a rename promotes the
+				# file atomically without copying the bytes or a separate delete
+				os.replace(f"{self.stagingDir}{filename}", f"{self.cacheDir}{filename}")
+				finalIndex[filename] = entry
+			elif entry[KEY_STATUS] == CACHE_STATUS_DELETED:
 				try:
-					r = requests.get(url, allow_redirects=True)
-				except Exception as e:
-					# might happen if network fails between head and get requests, so handle gracefully
-					del newIndex[filename]
-					if status == CACHE_STATUS_UPDATED:
-						newIndex[filename] = {KEY_STATUS : CACHE_STATUS_UPTODATE, KEY_LAST_MOD : oldIndex[filename][KEY_LAST_MOD]}
-					gap += 1
-			if r is not None:
-				if r.status_code != 200:
-					# might happen if network fails between head and get requests, so handle gracefully
-					del newIndex[filename]
-					if status == CACHE_STATUS_UPDATED:
-						newIndex[filename] = {KEY_STATUS : CACHE_STATUS_UPTODATE, KEY_LAST_MOD : oldIndex[filename][KEY_LAST_MOD]}
-					gap += 1
-				else:
-					open(stageName, 'wb').write(r.content)
-			imageNo += 1
-		# check that all images in the cache are now in the new index and add delete entries for any missing
+					os.remove(f"{self.cacheDir}{filename}")
+				except FileNotFoundError:
+					# a DELETED entry can come from the old index alone, with the
+					# file already gone from disk
+					pass
+			else:
+				finalIndex[filename] = entry
+		# cached images the scan never saw are gone from the repository too
 		for cached in cachedNames:
 			if cached not in newIndex:
-				newIndex[cached] = {KEY_STATUS : CACHE_STATUS_DELETED, KEY_LAST_MOD : None}
-		# new images and updates should now be in staging, and there should be an entry in new index for every file in staging or cached
-		for filename in newIndex:
-			stagingPath = self.stagingDir + filename
-			cachePath = self.cacheDir + filename
-			if newIndex[filename][KEY_STATUS] == CACHE_STATUS_NEW:
-				shutil.copy(stagingPath, self.cacheDir)
-			elif newIndex[filename][KEY_STATUS] == CACHE_STATUS_UPDATED:
-				os.remove(cachePath)
-				shutil.copy(stagingPath, self.cacheDir)
-			elif newIndex[filename][KEY_STATUS] == CACHE_STATUS_DELETED:
-				os.remove(cachePath)
-		# remove deleted entries from index and save it
-		indexFilenames = list(newIndex.keys())
-		for indexFilename in indexFilenames:
-			if newIndex[indexFilename][KEY_STATUS] == CACHE_STATUS_DELETED:
-				del newIndex[indexFilename]
+				os.remove(f"{self.cacheDir}{cached}")
+		self.enforceCacheLimit(finalIndex)
+		self.invalidateDirCache()
+		# write the index to a temp file and rename it into place, so a failure
+		# mid-write can never leave a truncated or missing index behind
+		tmpIndexName = f"{self.cacheIndexName}.tmp"
 		try:
-			os.remove(self.cacheIndexName)
-		except:
-			print(f"WARNING - Unable to delete old cache index {self.cacheIndexName}")
-		jsonIndex = json.dumps(newIndex)
-		try:
-			with open(self.cacheIndexName, 'w') as outfile:
-				outfile.write(jsonIndex)
+			with open(tmpIndexName, 'w') as outfile:
+				json.dump(finalIndex, outfile)
+			os.replace(tmpIndexName, self.cacheIndexName)
 		except:
 			print(f"WARNING - Unable to write cache index to {self.cacheIndexName}")
 		self.refreshImageNames()
 
 
+	def enforceCacheLimit(self, index):
+		'''
+		Evict least recently downloaded files from the cache directory until its
+		total size is within cacheLimitMB. Evicted files are removed from the
+		supplied index so they can be fetched again when space allows.
+		Does nothing if no limit is configured.
+		'''
+		if self.cacheLimitMB is None:
+			return
+		limitBytes = self.cacheLimitMB * 1024 * 1024
+		cached = []
+		totalSize = 0
+		with os.scandir(self.cacheDir) as entries:
+			for entry in entries:
+				if entry.is_file():
+					stat = entry.stat()
+					cached.append((stat.st_mtime, stat.st_size, entry.path, entry.name))
+					totalSize += stat.st_size
+		cached.sort()
+		for mtime, size, path, name in cached:
+			if totalSize <= limitBytes:
+				break
+			print(f"... Evicting {name} to keep the cache within {self.cacheLimitMB} MB")
+			os.remove(path)
+			totalSize -= size
+			if name in index:
+				del index[name]
+
+
 	def shuffleImageNames(self):
 		'''
 		Shuffle the list of image names
@@ -275,43 +407,36 @@ class ImageSet:
 		if len(self.imageNames) < 2:
 			return
 		lastShown = self.imageNames[self.imageCount - 1]
-		for r in range(3):
-			for i in range(self.imageCount):
-				t = random.randrange(self.imageCount)
-				if t != i:
-					sv = self.imageNames[i]
-					self.imageNames[i] = self.imageNames[t]
-					self.imageNames[t] = sv
+		random.shuffle(self.imageNames)
 		# make sure that the first image is not the last one that was shown
-		attempts = 0
-		while lastShown == self.imageNames[0] and attempts < 20:
-			attempts += 1
-			t = random.randrange(self.imageCount)
-			if t != i:
-				sv = self.imageNames[i]
-				self.imageNames[i] = self.imageNames[t]
-				self.imageNames[t] = sv
+		if self.imageNames[0] == lastShown:
+			t = random.randrange(1, self.imageCount)
+			self.imageNames[0], self.imageNames[t] = self.imageNames[t], self.imageNames[0]
 
 
 	def refreshImageNames(self):
 		'''
 		Refresh the image name list, current index and last update DTS
+		The sorted list is kept so later reordering does not rebuild it
 		'''
-		self.imageNames = self.getFilesIn(self.localDir, self.imageTypes) + self.getFilesIn(self.cacheDir, self.imageTypes)
+		localNames = self.getFilesIn(self.localDir, self.imageTypes)
+		self._sortedNames = localNames + self.getFilesIn(self.cacheDir, self.imageTypes)
+		self._localCount = len(localNames)
+		self.imageNames = list(self._sortedNames)
 		self.currentIndex = 0
 		if self.randomise:
 			self.shuffleImageNames()
-		self.lastUpdate = datetime.now()
+		self.lastUpdate = time.monotonic()
 
 
 	def orderImageNames(self):
 		'''
 		Returns the image name list to sorted order, local content first
 		Sets the current index to the first remote image in the set (if any, otherwise first local image)
+		Reuses the sorted list captured at the last refresh rather than rescanning
 		'''
-		self.imageNames = self.getFilesIn(self.localDir, self.imageTypes)
-		self.currentIndex = len(self.imageNames)
-		self.imageNames = self.imageNames + self.getFilesIn(self.cacheDir, self.imageTypes)
+		self.imageNames = list(self._sortedNames)
+		self.currentIndex = self._localCount
 		if self.currentIndex >= len(self.imageNames):
 			self.currentIndex = 0
 
@@ -323,8 +448,8 @@ class ImageSet:
 		if self.lastUpdate is None:
 			updateRequired = True
 		else:
-			tdelta = datetime.now() - self.lastUpdate
-			elapsedMins = ((tdelta.days * 86400) + tdelta.seconds) / 60
+			# monotonic time is immune to wall clock steps (eg NTP corrections)
+			elapsedMins = (time.monotonic() - self.lastUpdate) / 60
 			updateRequired = elapsedMins >= self.refreshMins
 		if updateRequired:
 			self.updateImages()
@@ -43,22 +43,26 @@ Requires:
 
 """
 
-import inspect
 import signal
+import sys
 import json
 import os
 import requests
 import shutil
 import random
-import socket
-import evdev 
+import threading
+import time
+import tkinter
+import evdev
 # import asyncio
 
+from collections import OrderedDict
 from guizero import App, Picture, Box
 from datetime import datetime, timedelta
 from gpiozero import Button, LED
+from PIL import Image
 
-from ImageSet import ImageSet
+from ImageSet import ImageSet, connected as probeNetwork
 
 LOG_LEVEL_FATAL = 3
 LOG_LEVEL_WARNING = 2
@@ -75,6 +79,9 @@ MODE_HOLD_TIME = 1
 BASE_DIR = "/home/tba/Code/SlideShow/"
 BASE_SPLASH = BASE_DIR + "splash.png"
 
+# number of decoded images kept in the in-memory cache
+IMAGE_CACHE_SLOTS = 8
+
 CK_IMAGE_SETS = "imageSets"
 CK_TITLE = "appTitle"
 CK_LOG_LEVEL = "logLevel"
@@ -159,25 +166,45 @@ def log(message, level=LOG_LEVEL_INFO):
 			levelStr = "    "
 		else:
 			levelStr = ""
-		preamble = f"{levelStr}[{inspect.stack()[1][3]}] " 
+		# sys._getframe just walks one frame up, where inspect.stack()
+		# captured (and introspected) the entire call stack per message
+		preamble = f"{levelStr}[{sys._getframe(1).f_code.co_name}] "
 		print(f"{preamble}{message}")
 	if level == LOG_LEVEL_FATAL:
 		raise Exception(message)
 
 
-def connected(host="8.8.8.8", port=53, timeout=3):
-    """
-    Check network connectivity
-    Host: 8.8.8.8 (google-public-dns-a.google.com)
-    OpenPort: 53/tcp
-    Service: domain (DNS/TCP)
-    """
-    try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        return True
-    except socket.error as ex:
-        return False
+# seconds between background network probes
+NETWORK_PROBE_SECS = 30
+
+# cached network state, None until the first probe completes
+# the probe itself is shared with ImageSet (imported as probeNetwork)
+networkUp = None
+
+
+def networkProbeLoop():
+	'''
+	Background loop keeping the cached network state fresh, so callers of
+	connected() never pay the probe's connection or timeout cost themselves
+	'''
+	global networkUp
+	while True:
+		networkUp = probeNetwork()
+		time.sleep(NETWORK_PROBE_SECS)
+
+
+def connected():
+	'''
+	Return the cached network state
+	Only probes synchronously if the background probe has not yet reported
+	'''
+	global networkUp
+	if networkUp is None:
+		networkUp = probeNetwork()
+	return networkUp
+
+
+threading.Thread(target=networkProbeLoop, daemon=True).start()
 
 
 def setModeLed():
@@ -213,6 +240,51 @@ autoMode = imageSets[currentSetIndex].auto
 setModeLed()
 
 
+# cache of decoded images keyed by path, most recently used last
+imageCache = OrderedDict()
+
+# the display size is fixed for the life of the app
+displaySize = getConfig(CK_DISPLAY_SIZE)
+
+
+def loadImage(imageName):
+	'''
+	Return a decoded PIL image for the given path, scaled to the display size.
+	Scaling is done once here with PIL, so the toolkit just blits the
+	ready-sized bitmap instead of rescaling a full-resolution image on
+	every show. Recently shown slides are held in an in-memory LRU cache
+	so cycling through a set does not decode or rescale the same files again.
+	'''
+	if imageName in imageCache:
+		imageCache.move_to_end(imageName)
+		return imageCache[imageName]
+	image = Image.open(imageName)
+	# thumbnail resizes in place, preserving the aspect ratio
+	image.thumbnail((displaySize[0], displaySize[1]), Image.LANCZOS)
+	image.load()
+	imageCache[imageName] = image
+	if len(imageCache) > IMAGE_CACHE_SLOTS:
+		imageCache.popitem(last=False)
+	return image
+
+
+def clearImageCache():
+	'''
+	Drop all cached images, used after a refresh may have changed the files on disk
+	'''
+	imageCache.clear()
+
+
+def showImage(imageName):
+	'''
+	Display an image on the picture widget, falling back to the splash image
+	'''
+	if imageName is None:
+		log(f"Showing default splash image {BASE_SPLASH}", LOG_LEVEL_WARNING)
+		imageName = BASE_SPLASH
+	picture.image = loadImage(imageName)
+
+
 def refreshImageSets():
 	'''
 	Update the image sets if required
@@ -224,6 +296,23 @@ def refreshImageSets():
 	for imgSet in imageSets:
 		imgSet.checkForRefresh()
 		log(f"Image set {imgSet.name} contains {imgSet.imageCount} images", LOG_LEVEL_VERBOSE)
+	# cached decodes may be stale once the files on disk have been refreshed
+	clearImageCache()
+
+
+refreshThread = None
+
+
+def startBackgroundRefresh():
+	'''
+	Run refreshImageSets on a worker thread unless one is already running
+	The GUI keeps showing slides while any downloads happen in the background
+	'''
+	global refreshThread
+	if refreshThread is not None and refreshThread.is_alive():
+		return
+	refreshThread = threading.Thread(target=refreshImageSets, daemon=True)
+	refreshThread.start()
 
 
 def showCurrentImage():
@@ -231,28 +320,27 @@ def showCurrentImage():
 	Disdplay the curreently selected image (in a safe way)
 	'''
 	if currentSetIndex is None or imageSets[currentSetIndex].currentImageName is None:
-		log(f"Showing default splash image {BASE_SPLASH}", LOG_LEVEL_WARNING)		
-		picture.image = BASE_SPLASH 
+		showImage(None)
 	else:
 		log(f"Showing image '{imageSets[currentSetIndex].currentImageName} from image set {currentSetIndex}", LOG_LEVEL_VERBOSE)
-		picture.image = imageSets[currentSetIndex].currentImageName
+		showImage(imageSets[currentSetIndex].currentImageName)
 
 
 def advanceImage():
 	'''
 	Update the display to the next image in the list
-	Supresses a possible image set refresh if in manual mode
+	Refreshes are never done here, they run on the background worker
 	'''
-	picture.image = imageSets[currentSetIndex].advanceImage(skipRefresh=not autoMode)
+	showImage(imageSets[currentSetIndex].advanceImage(skipRefresh=True))
 	log(f"Showing image '{imageSets[currentSetIndex].currentImageName} from image set {currentSetIndex}", LOG_LEVEL_VERBOSE)
 
 
 def previousImage():
 	'''
 	Update the display to the provious image in the list
-	Supresses a possible imgae set refresh if in manual mode
+	Refreshes are never done here, they run on the background worker
 	'''
-	picture.image = imageSets[currentSetIndex].previousImage(skipRefresh=not autoMode)
+	showImage(imageSets[currentSetIndex].previousImage(skipRefresh=True))
 	log(f"Showing image '{imageSets[currentSetIndex].currentImageName} from image set {currentSetIndex}", LOG_LEVEL_VERBOSE)
 
 
@@ -270,7 +358,7 @@ def setImageSetByIndex(setIndex):
 	autoMode = imageSets[currentSetIndex].auto
 	setModeLed()
 	log(f"Showing image {imageSets[currentSetIndex].currentImageName}", LOG_LEVEL_VERBOSE)
-	picture.image = imageSets[currentSetIndex].currentImageName
+	showImage(imageSets[currentSetIndex].currentImageName)
 
 
 def cycleImageSet(delta=1):
@@ -303,7 +391,7 @@ def modeHeldEvent():
 		setModeLed()
 		if not autoMode:
 			imageSets[currentSetIndex].orderImageNames()
-		picture.image = imageSets[currentIndex].currentImageName
+		showImage(imageSets[currentSetIndex].currentImageName)
 	else:
 		# multiple set mode
 		cycleImageSet()
@@ -335,8 +423,10 @@ def get_ir_device():
 def autoAdvance():
 	'''
 	Event handler triggered by repeat on picture
+	Kicks off a background refresh, which only downloads when a set is due
 	'''
 	if autoMode:
+		startBackgroundRefresh()
 		advanceImage()
 
 
@@ -354,6 +444,13 @@ IR_EVENT_HANDLERS = {
 	68 : previousImageSet,
 	64 : modeHeldEvent
 }
+
+# dense dispatch table indexed by event value, so the hot path does a
+# single list index instead of hashing into the dict for every event
+IR_DISPATCH = [None] * (max(IR_EVENT_HANDLERS) + 1)
+for value, handler in IR_EVENT_HANDLERS.items():
+	IR_DISPATCH[value] = handler
+
 IR_DEBOUNCE_SEC = 1
 
 last_IR_DTS = 0
@@ -365,6 +462,9 @@ def check_ir():
 	Check the IR remote receiver for events
 	'''
 	global last_IR_DTS
+	# bind the table locally, the loop may run for several queued events
+	dispatch = IR_DISPATCH
+	dispatchSize = len(dispatch)
 	try:
 		for ev in ir_recv.read():
 			if ev.type != 4:
@@ -373,9 +473,10 @@ def check_ir():
 				thisDTS = ev.sec + (ev.usec/1000000)
 				if (thisDTS - last_IR_DTS) >= IR_DEBOUNCE_SEC:
 					last_IR_DTS = thisDTS
-					if ev.value in IR_EVENT_HANDLERS:
-						log(f"Calling IR event handler {IR_EVENT_HANDLERS[ev.value].__name__}", LOG_LEVEL_INFO)
-						IR_EVENT_HANDLERS[ev.value]()
+					handler = dispatch[ev.value] if 0 <= ev.value < dispatchSize else None
+					if handler is not None:
+						log(f"Calling IR event handler {handler.__name__}", LOG_LEVEL_INFO)
+						handler()
 					else:
 						log(f"Unsupported IR event received, value = {ev.value}", LOG_LEVEL_VERBOSE)
 	except BlockingIOError:
@@ -385,7 +486,9 @@ def check_ir():
 
 modeLED.off()
 
-refreshImageSets()
+# the initial refresh also runs off the GUI thread, so the splash screen
+# appears immediately rather than after the first full set download
+startBackgroundRefresh()
 
 modeButton.when_held = modeHeldEvent
 advanceButton.when_pressed = advancePressedEvent
@@ -396,11 +499,36 @@ app.set_full_screen()
 picture = Picture(app, image=BASE_SPLASH)
 showCurrentImage()
 
-picture.width = getConfig(CK_DISPLAY_SIZE)[0]
-picture.height = getConfig(CK_DISPLAY_SIZE)[1]
+
+def showWhenRefreshed():
+	'''
+	One-shot poll on the GUI thread that redraws the current image once the
+	initial background refresh has finished. Without this a manual-mode set
+	would sit on the splash screen until a button press, since nothing else
+	repaints when the worker completes.
+	'''
+	if refreshThread is not None and refreshThread.is_alive():
+		app.after(500, showWhenRefreshed)
+	else:
+		showCurrentImage()
+
+
+app.after(500, showWhenRefreshed)
+
+# the widget stays at the fixed display size, images arrive pre-scaled
+picture.width = displaySize[0]
+picture.height = displaySize[1]
 
 picture.repeat(getConfig(CK_INTERVAL), autoAdvance)
 if ir_recv is not None:
-	picture.repeat(IR_POLLING_MS, check_ir)
+	# let the event loop wake check_ir only when the device actually has
+	# input, rather than polling it every IR_POLLING_MS
+	try:
+		app.tk.tk.createfilehandler(ir_recv.fd, tkinter.READABLE, lambda file, mask: check_ir())
+		log("IR receiver registered with the event loop", LOG_LEVEL_INFO)
+	except AttributeError:
+		# createfilehandler is not available on threaded Tcl builds
+		log("Event loop file handlers unavailable, falling back to polling the IR receiver", LOG_LEVEL_WARNING)
+		picture.repeat(IR_POLLING_MS, check_ir)
 
 app.display()